@@ -1,9 +1,41 @@
 import argparse
+import contextlib
 import requests
 import pandas as pd
+import numpy as np
 import datetime
+import hashlib
+import os
+import tempfile
+import time
 from openpyxl import load_workbook
+from openpyxl.packaging.custom import StringProperty
 import re
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import python_calamine  # noqa: F401 - only needed so pandas can use the Rust-backed reader
+    # pandas only gained the calamine engine in 2.2, so older versions stick with openpyxl even when the package is installed
+    EXCEL_READ_ENGINE = 'calamine' if tuple(int(part) for part in pd.__version__.split('.')[:2]) >= (2, 2) else 'openpyxl'
+except ImportError:
+    EXCEL_READ_ENGINE = 'openpyxl'
+
+try:
+    from orjson import loads as json_loads  # C-accelerated decoder for the endoflife.date payloads
+except ImportError:
+    from json import loads as json_loads
+
+# One session shared by every fetch (including the worker threads) so connections to endoflife.date are kept alive and reused.
+# requests already asks for gzip-compressed responses by default.
+SESSION = requests.Session()
+SESSION.headers.update({"Accept": "application/json"})
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'intune-osbc')
+CACHE_MAX_AGE = 24 * 60 * 60  # Seconds before cached endoflife.date data is revalidated
+REQUEST_TIMEOUT = 10  # Seconds to wait on endoflife.date before giving up on an OS
+LEADING_VERSION_RE = re.compile(r"^([\d\.]+)")
+SHEET_NAME_RE = re.compile(r'[^a-zA-Z0-9 ()_-]')
+SHEET_HASH_PREFIX = "Intune OS Build Checker hash: "  # Custom document property recording what each output sheet was last written with
 
 def obligatory_banner():
     ascii_art = r"""
@@ -17,129 +49,238 @@ by @FlyingPhishy - Why isn't this an accessible feature in Intune?
     """
     print(ascii_art)
 
-def fetch_os_builds(url):
+def write_file_atomic(path, data):
+    # Write alongside the target and swap it into place, so an interrupted run never leaves a half-written cache file
+    f = tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), delete=False)
+    try:
+        with f:
+            f.write(data)
+        os.replace(f.name, path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(f.name)
+        raise
+
+def read_cached_builds(cache_path):
+    with open(cache_path, 'rb') as f:
+        return json_loads(f.read())
+
+def fetch_os_builds(url, use_cache=True):
+    # The endoflife.date data changes at most daily, so keep a copy on disk and revalidate it with its ETag.
+    # The cache is only ever a shortcut: if it can't be read or written the data is still fetched and returned.
+    cache_path = os.path.join(CACHE_DIR, url.rstrip('/').rsplit('/', 1)[-1])
+    etag_path = f"{cache_path}.etag"
+    headers = {}
+
+    if use_cache:
+        try:
+            if os.path.exists(cache_path):
+                if time.time() - os.path.getmtime(cache_path) < CACHE_MAX_AGE:
+                    builds = read_cached_builds(cache_path)
+                    print(f"Using cached OS builds data for {url}")
+                    return builds
+                if os.path.exists(etag_path):
+                    with open(etag_path) as f:
+                        headers["If-None-Match"] = f.read().strip()
+        except (OSError, ValueError) as e:  # ValueError covers a cached body that isn't valid JSON
+            print(f"Couldn't read cached OS builds data for {url}, fetching it instead: {e}")
+            headers = {}
+
     print(f"Fetching OS builds data from {url}")
-    headers = {"Accept": "application/json"}
-    response = requests.get(url, headers=headers)
-    builds = response.json()
+    response = SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304:
+        try:
+            os.utime(cache_path)  # Still current, so restart the clock on the cached copy
+            return read_cached_builds(cache_path)
+        except (OSError, ValueError):
+            # The cached copy went missing or is corrupt, so ask for the full body instead
+            response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
+
+    response.raise_for_status()
+
+    builds = json_loads(response.content)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        if os.path.exists(etag_path):
+            os.remove(etag_path)  # Never leave an ETag beside a body it didn't come with
+        write_file_atomic(cache_path, response.content)  # Cache the body as received rather than re-serialising it
+        if response.headers.get("ETag"):
+            write_file_atomic(etag_path, response.headers["ETag"].encode())
+    except OSError as e:
+        print(f"Couldn't cache OS builds data for {url}: {e}")
     return builds
 
-def is_supported(os_version, build_data, os_name):
+def fetch_all_os_builds(api_endpoints, use_cache=True):
+    # The endpoints are independent, so fetch them side by side rather than one after another
+    os_data = {}
+    with ThreadPoolExecutor(max_workers=len(api_endpoints)) as executor:
+        futures = {os_name: executor.submit(fetch_os_builds, url, use_cache) for os_name, url in api_endpoints.items()}
+        for os_name, future in futures.items():
+            try:
+                os_data[os_name] = future.result()
+            except Exception as e:
+                print(f"Failed to fetch {os_name} builds, skipping: {e}")
+    return os_data
+
+def parse_date(value):
     try:
-        today = datetime.date.today()
-        if os_name == 'Windows':
-            major_build = str(os_version).split('.')[:3]  # Getting the third part of the version number
-            matching_builds = [build for build in build_data if major_build == build['latest'].split('.')[:3]]
-            
-            if len(matching_builds) == 1:
-                build = matching_builds[0]
-            elif len(matching_builds) > 1:
-                w_build = next((build for build in matching_builds if "(W)" in build.get('releaseLabel', '')), None)
-                build = w_build if w_build else matching_builds[0]
-            else:
-                return None
-            
-            eol_date = build.get('eol')
-            if eol_date is None:
-                build['supported'] = "No EoL"
-            else:
-                eol_date = datetime.datetime.strptime(eol_date, "%Y-%m-%d").date()
-                build['supported'] = "Supported" if today <= eol_date else "End of Life"
-            return build
-        
-        elif os_name.startswith('Android'):
-            major_version = '.'.join(str(os_version).split('.')[:2])  # Dropping the third period and anything after
-            for build in build_data:
-                if str(build['cycle']) == major_version:
-                    eol_date = build.get('eol', None)
-                    if eol_date is False:  # Checking for 'false' explicitly, as it represents no end of life
-                        build['supported'] = "No EoL"
-                    elif isinstance(eol_date, str):
-                        eol_date = datetime.datetime.strptime(eol_date, "%Y-%m-%d").date()
-                        build['supported'] = "Supported" if today <= eol_date else "End of Life"
-                    else:
-                        build['supported'] = "Unknown"
-                    return build
-                
-            if not any(str(build['cycle']) == major_version for build in build_data):
-                major_version = str(os_version).split('.')[0]
-                for build in build_data:
-                    if str(build['cycle']) == major_version:
-                        eol_date = build.get('eol', None)
-                        if eol_date is False:  # Checking for 'false' explicitly, as it represents no end of life
-                            build['supported'] = "No EoL"
-                        elif isinstance(eol_date, str):
-                            eol_date = datetime.datetime.strptime(eol_date, "%Y-%m-%d").date()
-                            build['supported'] = "Supported" if today <= eol_date else "End of Life"
-                        else:
-                            build['supported'] = "Unknown"
-                        return build
-
-            return {"supported": "Unknown Version", "releaseDate": "N/A", "eol": "N/A", "codename": "N/A"}
-                    
-        elif os_name in ['iOS/iPadOS', 'macOS']:
-            major_version = str(os_version).split('.')[0]
-            for build in build_data:
-                if str(build['cycle']) == str(major_version):
-                    eol_date = build.get('eol', None)
-                    if eol_date is False:
-                        build['supported'] = "No EoL"
-                    elif isinstance(eol_date, str):
-                        eol_date = datetime.datetime.strptime(eol_date, "%Y-%m-%d").date()
-                        build['supported'] = "Supported" if today <= eol_date else "End of Life"
-                    else:
-                        build['supported'] = "Unknown"
-                    return build
-                    
-        return {"supported": "Unknown Version", "releaseDate": "N/A", "eol": "N/A", "codename": "N/A"}
-    except (IndexError, AttributeError, ValueError):  # Handling cases with empty or malformed data
-        return "Invalid Data"
-
-
-def is_latest(os_version, build_data):
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):  # Not a date string, e.g. 'eol' can be true/false
+        return None
+
+def index_builds(build_data, os_name):
+    # Everything the per-version checks need, gathered in a single pass over the builds
+    build_index = {}
+    latest_versions = set()
     for build in build_data:
-        if build.get('latest') == os_version:
-            return True
-    return False
+        build['_eol_date'] = parse_date(build.get('eol'))  # Parsed once here rather than for every row that matches the build
+        if build.get('latest'):
+            latest_versions.add(build['latest'])
+        if os_name == 'Windows':
+            major_build = '.'.join(build['latest'].split('.')[:3])  # Keyed on the first three parts of the build number
+            current = build_index.get(major_build)
+            # Favour the "(W)" release when several builds share the same number
+            if current is None or ("(W)" in build.get('releaseLabel', '') and "(W)" not in current.get('releaseLabel', '')):
+                build_index[major_build] = build
+        else:
+            build_index.setdefault(str(build['cycle']), build)
+    return build_index, frozenset(latest_versions)
+
+def find_build(os_version, build_index, os_name):
+    if os_name == 'Windows':
+        major_build = '.'.join(str(os_version).split('.')[:3])  # Getting the third part of the version number
+        return build_index.get(major_build)
+    elif os_name.startswith('Android'):
+        major_version = '.'.join(str(os_version).split('.')[:2])  # Dropping the third period and anything after
+        build = build_index.get(major_version)
+        if build is None:
+            build = build_index.get(str(os_version).split('.')[0])
+        return build
+    elif os_name in ['iOS/iPadOS', 'macOS']:
+        return build_index.get(str(os_version).split('.')[0])
+    return None
 
-def process_excel(file_path, sheet_name, os_data):
+def support_status(builds, os_name, today):
+    # Works on the whole column at once, comparing the EOL dates index_builds already parsed
+    eol = builds.map(lambda build: build.get('eol') if build else None)
+    eol_dates = pd.to_datetime(builds.map(lambda build: build['_eol_date'] if build else None))
+    no_eol = eol.map(lambda eol_date: eol_date is False).astype(bool)  # 'false' represents no end of life
+    if os_name == 'Windows':
+        no_eol |= builds.notna() & eol.isna()
+    status = np.select(
+        [builds.isna(), eol_dates >= today, eol_dates.notna(), no_eol],
+        ["Unknown Version", "Supported", "End of Life", "No EoL"],
+        default="Unknown"
+    )
+    return pd.Series(status, index=builds.index, dtype=object)
+
+
+def hash_sheet(os_df):
+    digest = hashlib.md5('\x00'.join(map(str, os_df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(os_df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+def read_sheet_hashes(workbook):
+    props = workbook.custom_doc_props
+    return {
+        name: props[f"{SHEET_HASH_PREFIX}{name}"].value
+        for name in workbook.sheetnames
+        if f"{SHEET_HASH_PREFIX}{name}" in props.names
+    }
+
+def load_sheet(file_path, sheet_name):
+    # Returns the input sheet along with the hashes stored by the last run. When openpyxl is doing the reading it has
+    # already opened the workbook (read-only), so the hashes are taken from that rather than opening the file again.
+    with pd.ExcelFile(file_path, engine=EXCEL_READ_ENGINE) as excel_file:
+        df = excel_file.parse(sheet_name)
+        if EXCEL_READ_ENGINE == 'openpyxl':
+            return df, read_sheet_hashes(excel_file.book)
+
+    workbook = load_workbook(file_path, read_only=True)
+    try:
+        return df, read_sheet_hashes(workbook)
+    finally:
+        workbook.close()
+
+def write_sheet_hashes(workbook, sheet_hashes):
+    props = workbook.custom_doc_props
+    for name, sheet_hash in sheet_hashes.items():
+        prop_name = f"{SHEET_HASH_PREFIX}{name}"
+        if prop_name in props.names:
+            props[prop_name].value = sheet_hash
+        else:
+            props.append(StringProperty(name=prop_name, value=sheet_hash))
+
+def process_excel(file_path, sheet_name, os_data, today=None, force=False):
     print(f"Loading data from {file_path}...")
     try:
-        df = pd.read_excel(file_path, sheet_name=sheet_name)
+        df, stored_hashes = load_sheet(file_path, sheet_name)
+        # Taken once for the whole run so every row (and the sheet hashes) are judged against the same day
+        today = pd.Timestamp(today if today is not None else datetime.date.today())
 
+        # Tag every row with its OS and split the sheet once, rather than re-filtering it per OS. The OS column only holds
+        # a few distinct values, so those are matched against the OS names and the result spread back over the rows.
+        os_names = list(os_data)
+        os_codes, unique_os = pd.factorize(df['OS'], use_na_sentinel=False)
+        unique_lower = pd.Series(unique_os, dtype=object).fillna('').astype(str).str.lower()
+        unique_family = np.select([unique_lower.str.contains(os_name.lower(), regex=False) for os_name in os_names], os_names, default='')
+        os_family = unique_family[os_codes]
+        os_groups = dict(tuple(df.groupby(os_family, sort=False)))
+
+        sheets = {}
         for os_name, build_data in os_data.items():
             print(f"Processing {os_name} data...")
-            os_df = df[df['OS'].str.contains(os_name, na=False, case=False)].copy() 
+            os_df = os_groups.get(os_name, df.iloc[0:0]).reset_index(drop=True)
 
             if os_name == 'Windows':
-                os_df.loc[:, 'Supported'] = os_df['OS version'].apply(
-                    lambda x: is_supported(x, build_data, os_name)['supported'] if is_supported(x, build_data, os_name) else "Unknown Version"
-                )
-                os_df.loc[:, 'Release Label'] = os_df['OS version'].apply(
-                    lambda x: is_supported(x, build_data, os_name)['releaseLabel'] if is_supported(x, build_data, os_name) else "N/A"
-                )
-                os_df.loc[:, 'Release Date'] = os_df['OS version'].apply(
-                    lambda x: is_supported(x, build_data, os_name)['releaseDate'] if is_supported(x, build_data, os_name) else "N/A"
-                )
-                os_df.loc[:, 'EOL Date'] = os_df['OS version'].apply(
-                    lambda x: is_supported(x, build_data, os_name)['eol'] if is_supported(x, build_data, os_name) and 'eol' in is_supported(x, build_data, os_name) else "N/A"
-                )
+                columns = {'Release Label': 'releaseLabel', 'Release Date': 'releaseDate', 'EOL Date': 'eol'}
+            elif os_name.startswith('Android'):
+                columns = {'Release Date': 'releaseDate', 'EOL Date': 'eol', 'Codename': 'codename'}
             else:
-                # For Android, iOS/iPadOS, and macOS, continue using 'cycle'
-                os_df.loc[:, 'Supported'] = os_df['OS version'].apply(lambda x: is_supported(x, build_data, os_name)['supported'] if is_supported(x, build_data, os_name) else "Unknown Version")
-                os_df.loc[:, 'Release Date'] = os_df['OS version'].apply(lambda x: is_supported(x, build_data, os_name)['releaseDate'] if is_supported(x, build_data, os_name) else "N/A")
-                os_df.loc[:, 'EOL Date'] = os_df['OS version'].apply(lambda x: is_supported(x, build_data, os_name).get('eol', "N/A") if is_supported(x, build_data, os_name) else "N/A")
-                if os_name.startswith('Android'):
-                    os_df.loc[:, 'Codename'] = os_df['OS version'].apply(lambda x: is_supported(x, build_data, os_name).get('codename', "N/A") if is_supported(x, build_data, os_name) else "N/A")
-                elif os_name in ['iOS/iPadOS', 'macOS']:
-                    os_df.loc[:, 'Latest Version'] = os_df['OS version'].apply(
-                        lambda x: is_latest(re.match(r"([\d\.]+)", str(x)).group(1) if re.match(r"([\d\.]+)", str(x)) else str(x), build_data)
-                    )
-
-            with pd.ExcelWriter(file_path, mode='a', engine='openpyxl', if_sheet_exists='replace') as writer:
-                clean_os_name = re.sub(r'[^a-zA-Z0-9 ()_-]', '', os_name)
-                os_df.to_excel(writer, sheet_name=f"{clean_os_name} Versions", index=False)
-        
+                columns = {'Release Date': 'releaseDate', 'EOL Date': 'eol'}
+
+            # Index the builds once so each row is a dict lookup rather than a scan of build_data
+            build_index, latest_versions = index_builds(build_data, os_name)
+            # Devices share a handful of versions, so work everything out once per unique version and spread the results back over the rows
+            version_codes, unique_versions = pd.factorize(os_df['OS version'], use_na_sentinel=False)
+            builds = pd.Series([find_build(os_version, build_index, os_name) for os_version in unique_versions], dtype=object)
+
+            # Pull every field out of the builds in one pass and assign the columns together.
+            # Versions with no matching build all share the same "N/A" row rather than each getting a new one.
+            unknown_info = ("N/A",) * len(columns)
+            build_info = [tuple(build.get(key, "N/A") for key in columns.values()) if build else unknown_info for build in builds]
+            resolved = pd.DataFrame(build_info, columns=list(columns))
+            resolved.insert(0, 'Supported', support_status(builds, os_name, today))
+
+            if os_name in ['iOS/iPadOS', 'macOS']:
+                versions = pd.Series(unique_versions, dtype=object).astype(str)
+                # Strip anything after the numeric version (e.g. "15.8 (21H1)") across the whole column at once
+                versions = versions.str.extract(LEADING_VERSION_RE, expand=False).fillna(versions)
+                resolved['Latest Version'] = versions.isin(latest_versions)
+
+            # Write each new column onto the sheet in one assignment, expanding the per-version results to every row
+            for column in resolved:
+                os_df[column] = resolved[column].to_numpy()[version_codes]
+
+            clean_os_name = SHEET_NAME_RE.sub('', os_name)
+            sheets[f"{clean_os_name} Versions"] = os_df
+
+        # Rewriting the workbook is the slowest step, so skip sheets whose content hasn't changed since the last run.
+        # The stored hashes only reflect what was last written, so force ignores them to restore sheets edited by hand.
+        sheet_hashes = {name: hash_sheet(os_df) for name, os_df in sheets.items()}
+        if force:
+            stored_hashes = {}
+        changed_sheets = [name for name in sheets if stored_hashes.get(name) != sheet_hashes[name]]
+        if not changed_sheets:
+            print("No changes since the last run, the Excel file has been left as is.")
+            return
+
+        # Open the workbook once and write every sheet before saving, rather than rewriting it per OS
+        with pd.ExcelWriter(file_path, mode='a', engine='openpyxl', if_sheet_exists='replace') as writer:
+            for name in changed_sheets:
+                sheets[name].to_excel(writer, sheet_name=name, index=False)
+            write_sheet_hashes(writer.book, {name: sheet_hashes[name] for name in changed_sheets})
+
         print("Successfully updated the Excel file with new data.")
     except Exception as e:
         print(f"Failed to process the Excel file: {e}")
@@ -149,6 +290,8 @@ def setup_argparse():
     parser = argparse.ArgumentParser(description='Process OS build numbers to check support status.')
     parser.add_argument('-f', '--file', type=str, required=True, help='Path to the Excel file to be processed')
     parser.add_argument('-s', '--sheet', type=str, required=True, help='Name of the sheet to read from')
+    parser.add_argument('--no-cache', action='store_true', help='Ignore cached endoflife.date data and fetch it again')
+    parser.add_argument('--force', action='store_true', help='Rewrite every output sheet, even if it looks unchanged since the last run')
     return parser
 
 def main():
@@ -156,14 +299,18 @@ def main():
     parser = setup_argparse()
     args = parser.parse_args()
     
-    os_data = {
-        'Windows': fetch_os_builds("https://endoflife.date/api/windows.json"),
-        'Android': fetch_os_builds("https://endoflife.date/api/android.json"),
-        'iOS/iPadOS': fetch_os_builds("https://endoflife.date/api/ios.json"),
-        'macOS': fetch_os_builds("https://endoflife.date/api/macos.json")
+    api_endpoints = {
+        'Windows': "https://endoflife.date/api/windows.json",
+        'Android': "https://endoflife.date/api/android.json",
+        'iOS/iPadOS': "https://endoflife.date/api/ios.json",
+        'macOS': "https://endoflife.date/api/macos.json"
     }
+    os_data = fetch_all_os_builds(api_endpoints, use_cache=not args.no_cache)
+    if not os_data:
+        print("No OS builds data could be fetched, so there is nothing to check.")
+        return
     
-    process_excel(args.file, args.sheet, os_data)
+    process_excel(args.file, args.sheet, os_data, force=args.force)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file